@@ -0,0 +1,68 @@
+##
+# The MIT License (MIT)
+#
+# Copyright (c) 2016 Stefan Wendler
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+##
+
+
+
+class BufferedSerial(object):
+    """
+    Wraps a pyserial port and reads everything that is waiting in one go.
+    Subsequent small reads (e.g. the byte-by-byte loop in Pyboard.read_until)
+    are served from the buffer instead of hitting the driver each time.
+    All other attributes are passed through to the wrapped port.
+    """
+
+    def __init__(self, serial):
+
+        self.serial = serial
+        self.buf = bytearray()
+
+    def __getattr__(self, name):
+
+        return getattr(self.serial, name)
+
+    def read(self, size=1):
+
+        if len(self.buf) < size:
+            self.buf.extend(self.serial.read(max(size - len(self.buf), self.serial.inWaiting())))
+
+        data = bytes(self.buf[:size])
+        del self.buf[:size]
+
+        return data
+
+    def inWaiting(self):
+
+        if len(self.buf):
+            return len(self.buf)
+
+        return self.serial.inWaiting()
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def reset_input_buffer(self):
+
+        self.buf = bytearray()
+        self.serial.reset_input_buffer()
@@ -24,6 +24,7 @@
 
 
 import os
+import posixpath
 import re
 import sre_constants
 import binascii
@@ -144,6 +145,10 @@ class MpFileExplorer(Pyboard):
             fqn = fqn[:-1]
         return fqn
 
+    def _abspath(self, target):
+        # _fqn strips the trailing slash, which leaves nothing for the root
+        return posixpath.normpath(self._fqn(target) or "/")
+
     def __set_sysname(self):
         self.sysname = self.eval("os.uname()[0]").decode('utf-8')
 
@@ -209,6 +214,55 @@ class MpFileExplorer(Pyboard):
 
         return files
 
+    @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
+    def tree(self, target):
+        """
+        List the remote directory tree below target in a single exchange.
+        The remote prints one "<depth> <D|F> <name>" line per entry while it
+        walks, the nesting is rebuilt here. This keeps the memory needed on
+        the device independent of the size of the tree.
+
+        :param target:      Remote directory
+        :return:            Dict mapping names to a dict for directories and None for files
+        """
+
+        root = self._abspath(target)
+
+        try:
+            res = self.exec_with_exception(
+                "def w(p, d):\n"
+                "  for f in os.listdir(p):\n"
+                "    q = p + ('' if p.endswith('/') else '/') + f\n"
+                "    if os.stat(q)[0] & 0o0040000:\n"
+                "      print(d, 'D', f)\n"
+                "      w(q, d + 1)\n"
+                "    else:\n"
+                "      print(d, 'F', f)\n"
+                "w(%r, 0)" % root
+            )
+        except InternalError as e:
+            if e.exception == "OSError":
+                raise RemoteIOError(os.strerror(e.args[0])+(": %s" % target))
+            else:
+                raise RemoteIOError("Unknown error: %s" % e.msg)
+
+        tree = {}
+        parents = [tree]
+
+        for line in res.decode('utf-8').splitlines():
+            depth, kind, name = line.split(" ", 2)
+            depth = int(depth)
+
+            del parents[depth + 1:]
+
+            if kind == 'D':
+                parents[depth][name] = {}
+                parents.append(parents[depth][name])
+            else:
+                parents[depth][name] = None
+
+        return tree
+
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def rm(self, target):
         try:
@@ -259,17 +313,75 @@ class MpFileExplorer(Pyboard):
             else:
                 raise RemoteIOError("Unknown error: %s" % e.msg)
 
+    @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
+    def _match_files(self, pat):
+        """
+        Names of the files in the current remote directory matching the given
+        regular expression. The listing is fetched in a single exchange, the
+        matching is done here to keep the full Python regex syntax.
+        """
+
+        try:
+            find = re.compile(pat)
+        except sre_constants.error as e:
+            raise RemoteIOError("Error in regular expression: %s" % e)
+
+        try:
+            res = self.exec_with_exception(
+                "d = %r\n"
+                "p = d + ('' if d.endswith('/') else '/')\n"
+                "for f in os.listdir(d):\n"
+                "  if os.stat(p + f)[0] & 0o0100000:\n"
+                "    print(f)" % self.dir
+            )
+        except InternalError as e:
+            if e.exception == "OSError":
+                raise RemoteIOError(os.strerror(e.args[0])+(": %s" % self.dir))
+            else:
+                raise RemoteIOError("Unknown error: %s" % e.msg)
+
+        return [f for f in res.decode('utf-8').splitlines() if find.match(f)]
+
     def mrm(self, pat, verbose=False):
 
-        files = self.ls(add_dirs=False)
-        find = re.compile(pat)
+        files = self._match_files(pat)
+
+        if not len(files):
+            return
+
+        pending = bytearray()
+
+        def data_consumer(data):
+            pending.extend(data)
+
+            while True:
+                end = pending.find(b"\n")
+                if end < 0:
+                    break
+
+                name = bytes(pending[:end]).decode("utf-8", "replace").rstrip("\r")
+                del pending[:end + 1]
 
-        for f in files:
-            if find.match(f):
                 if verbose:
-                    print(" * rm %s" % f)
+                    print(" * rm %s" % name)
 
-                self.rm(f)
+        # remove all matches in one go instead of one exchange per file, the
+        # remote prints each name once removed to keep the idle timeout from
+        # expiring on large selections
+        try:
+            self.exec_with_exception(
+                "d = %r\n"
+                "p = d + ('' if d.endswith('/') else '/')\n"
+                "for f in %r:\n"
+                "  os.remove(p + f)\n"
+                "  print(f)" % (self.dir, files),
+                data_consumer=data_consumer
+            )
+        except InternalError as e:
+            if e.exception == "OSError":
+                raise RemoteIOError(os.strerror(e.args[0])+(": %s" % pat))
+            else:
+                raise RemoteIOError("Unknown error: %s" % e.msg)
 
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def put(self, src, dst=None):
@@ -409,9 +521,84 @@ class MpFileExplorer(Pyboard):
         f.write(self.get_file_contents(src))
         f.close()
 
+    def get_many(self, files):
+        """
+        Download several remote files in a single exchange. The remote prints
+        every chunk of every file as a bytes literal on its own line, a chunk
+        shorter than BIN_CHUNK_SIZE ends a file. Each chunk is written to disk
+        as soon as its line arrives.
+
+        :param files:       List of (remote file, local file) tuples
+        """
+
+        if not len(files):
+            return
+
+        pending = bytearray()
+        state = {"done": 0, "file": None, "error": None}
+
+        def data_consumer(data):
+            # after a local error just let the exchange drain, raising here
+            # would leave the raw REPL out of sync
+            if state["error"] is not None:
+                return
+
+            pending.extend(data)
+
+            try:
+                while True:
+                    end = pending.find(b"\n")
+                    if end < 0:
+                        break
+
+                    chunk = eval(bytes(pending[:end]).strip())
+                    del pending[:end + 1]
+
+                    if state["file"] is None:
+                        state["file"] = open(files[state["done"]][1], "wb")
+
+                    state["file"].write(chunk)
+
+                    if len(chunk) < self.BIN_CHUNK_SIZE:
+                        state["file"].close()
+                        state["file"] = None
+                        state["done"] += 1
+            except Exception as e:
+                state["error"] = e
+                del pending[:]
+
+                if state["file"] is not None:
+                    state["file"].close()
+                    state["file"] = None
+
+        try:
+            self.exec_with_exception(
+                "for n in %r:\n"
+                "  f = open(n, 'rb')\n"
+                "  while True:\n"
+                "    c = f.read(%d)\n"
+                "    print(repr(c))\n"
+                "    if not len(c) == %d:\n"
+                "      break\n"
+                "  f.close()"
+                % ([src for src, _ in files], self.BIN_CHUNK_SIZE, self.BIN_CHUNK_SIZE),
+                data_consumer=data_consumer
+            )
+        except InternalError as e:
+            if e.exception == "OSError":
+                raise RemoteIOError(os.strerror(e.args[0])+(": %s" % files[state["done"]][0]))
+            else:
+                raise RemoteIOError("Unknown error: %s" % e.msg)
+        finally:
+            if state["file"] is not None:
+                state["file"].close()
+
+        if state["error"] is not None:
+            raise RemoteIOError(str(state["error"]))
+
     def getr(self, src, dst = None):
         try:
-            res = self.eval_with_exception("os.stat('%s')" % self._fqn(src))
+            res = self.eval_with_exception("os.stat('%s')" % self._abspath(src))
             stat = eval(res)
             if not stat[0] & 0o0040000:
                 raise RemoteIOError("Remote directory %s is not a directory" % self._fqn(src))
@@ -424,41 +611,35 @@ class MpFileExplorer(Pyboard):
         if dst is None:
             dst = src.split("/")[-1]
 
-        try:
-            stat = os.stat(dst)
-            if not stat[0] & 0o0040000:
-                raise RemoteIOError("Local directory %s is not a directory" % self._fqn(dst))
-        except FileNotFoundError:
-            os.mkdir(dst)
-
-        olddir = self.pwd()
-        self.cd(src)
-        files = self.ls(add_dirs=False)
-        for file in files:
-            self.get(file, dst+('/' if dst[-1]!= '/' else '')+file)
+        files = []
 
-        dirs = self.ls(add_files=False)
-        for directory in dirs:
-            self.getr(directory,dst+('/' if dst[-1]!= '/' else '')+directory)
+        def collect(tree, src, dst):
+            try:
+                stat = os.stat(dst)
+                if not stat[0] & 0o0040000:
+                    raise RemoteIOError("Local directory %s is not a directory" % dst)
+            except FileNotFoundError:
+                os.mkdir(dst)
+
+            for name, sub in tree.items():
+                if sub is None:
+                    files.append((posixpath.join(src, name), os.path.join(dst, name)))
+                else:
+                    collect(sub, posixpath.join(src, name), os.path.join(dst, name))
 
-        self.cd(olddir)
+        # the whole tree is listed and downloaded in one exchange each
+        collect(self.tree(src), self._abspath(src), dst)
+        self.get_many(files)
 
     def mget(self, dst_dir, pat, verbose=False):
 
-        try:
-
-            files = self.ls(add_dirs=False)
-            find = re.compile(pat)
+        files = self._match_files(pat)
 
+        if verbose:
             for f in files:
-                if find.match(f):
-                    if verbose:
-                        print(" * get %s" % f)
+                print(" * get %s" % f)
 
-                    self.get(f, dst=os.path.join(dst_dir, f))
-
-        except sre_constants.error as e:
-            raise RemoteIOError("Error in regular expression: %s" % e)
+        self.get_many([(posixpath.join(self.dir, f), os.path.join(dst_dir, f)) for f in files])
 
     @retry(PyboardError, tries=MAX_TRIES, delay=1, backoff=2, logger=logging.root)
     def gets(self, src):
@@ -577,6 +758,11 @@ class MpFileExplorerCaching(MpFileExplorer):
 
         return None
 
+    def __uncache(self, path):
+
+        logging.debug("uncaching '%s'" % path)
+        self.cache.pop(path, None)
+
     def ls(self, add_files=True, add_dirs=True, add_details=False):
 
         hit = self.__cache_hit(self.dir)
@@ -673,3 +859,11 @@ class MpFileExplorerCaching(MpFileExplorer):
                     files.append(f)
 
             self.__cache(parent, files)
+
+    def mrm(self, pat, verbose=False):
+
+        try:
+            MpFileExplorer.mrm(self, pat, verbose)
+        finally:
+            # if removing failed midway it is unknown which matches are gone
+            self.__uncache(self.dir)
@@ -23,14 +23,17 @@
 ##
 
 
-import io
 import cmd
+import codecs
 import os
 import argparse
 import colorama
+import functools
 import glob
 import platform
+import re
 import sys
+import time
 import serial
 import logging
 
@@ -40,29 +43,88 @@ from mp.mpfexp import MpFileExplorerCaching
 from mp.mpfexp import RemoteIOError
 from mp.pyboard import PyboardError
 from mp.conbase import ConError
+from mp.conserial import ConSerial
+from mp.buffered_serial import BufferedSerial
 from mp.tokenizer import Tokenizer
 
+try:
+    from mp.term import Term
+    _TERM_IMPORT_ERROR = None
+except ImportError as e:
+    Term = None
+    _TERM_IMPORT_ERROR = e
+
+
+_IS_WINDOWS = platform.system() == "Windows"
+
+
+def _pyserial_version():
+    # pre-release versions like "3.5b0" have no plain minor number, only take
+    # the leading digits and give up (None) if even those don't parse
+    match = re.match(r"(\d+)\.(\d+)", serial.VERSION)
+    return tuple(int(x) for x in match.groups()) if match else None
+
+
+_PYSERIAL_VER = _pyserial_version()
+
+_tokenizer = Tokenizer()
+
+
+@functools.lru_cache(maxsize=128)
+def _tokenize(args):
+    # the scanner keeps no state between calls, so results can be shared
+    tokens, rest = _tokenizer.tokenize(args)
+    return tuple(tokens), rest
+
 
 class MpFileShell(cmd.Cmd):
 
-    def __init__(self, color=False, caching=False, reset=False):
-        if color:
+    LS_CACHE_TTL = 2.0
+
+    def __init__(self, color=False, caching=False, reset=False, low_latency=True, noninteractive=False):
+        # nobody looks at a non interactive run, so don't patch stdout for colors
+        if color and not noninteractive:
             colorama.init()
             cmd.Cmd.__init__(self, stdout=colorama.initialise.wrapped_stdout)
         else:
             cmd.Cmd.__init__(self)
         self.use_rawinput = False
 
-        self.color = color
+        self.color = color and not noninteractive
+        self.noninteractive = noninteractive
         self.caching = caching
         self.reset = reset
+        self.low_latency = low_latency
+
+        if self.color:
+            self._file_fmt = colorama.Fore.CYAN + "       %s" + colorama.Fore.RESET
+            self._dir_fmt = colorama.Fore.MAGENTA + " <dir> %s" + colorama.Fore.RESET
+            self._tree_file_fmt = colorama.Fore.CYAN + "%s%s" + colorama.Fore.RESET
+            self._tree_dir_fmt = colorama.Fore.MAGENTA + "%s%s" + colorama.Fore.RESET
+            self._error_fmt = '\n' + colorama.Fore.RED + '%s' + colorama.Fore.RESET + '\n'
+            self._prompt_tmpl = colorama.Fore.BLUE + "mpfs [" + \
+                                colorama.Fore.YELLOW + "%s" + \
+                                colorama.Fore.BLUE + "]> " + colorama.Fore.RESET
+        else:
+            self._file_fmt = "       %s"
+            self._dir_fmt = " <dir> %s"
+            self._tree_file_fmt = "%s%s"
+            self._tree_dir_fmt = "%s%s"
+            self._error_fmt = '\n%s\n'
+            self._prompt_tmpl = "mpfs [%s]> "
 
         self.fe = None
         self.repl = None
-        self.tokenizer = Tokenizer()
 
-        self.__intro()
-        self.__set_prompt_path()
+        self._ls_cache = {}
+        self._compl_cache = {}
+
+        if self.noninteractive:
+            self.intro = ''
+            self.prompt = ''
+        else:
+            self.__intro()
+            self.__set_prompt_path()
 
     def __del__(self):
         self.__disconnect()
@@ -81,24 +143,19 @@ class MpFileShell(cmd.Cmd):
 
     def __set_prompt_path(self):
 
+        if self.noninteractive:
+            return
+
         if self.fe is not None:
             pwd = self.fe.pwd()
         else:
             pwd = "/"
 
-        if self.color:
-            self.prompt = colorama.Fore.BLUE + "mpfs [" + \
-                          colorama.Fore.YELLOW + pwd + \
-                          colorama.Fore.BLUE + "]> " + colorama.Fore.RESET
-        else:
-            self.prompt = "mpfs [" + pwd + "]> "
+        self.prompt = self._prompt_tmpl % pwd
 
     def __error(self, msg):
 
-        if self.color:
-            print('\n' + colorama.Fore.RED + msg + colorama.Fore.RESET + '\n')
-        else:
-            print('\n' + msg + '\n')
+        print(self._error_fmt % msg)
 
     def __connect(self, port):
 
@@ -111,6 +168,10 @@ class MpFileShell(cmd.Cmd):
                 self.fe = MpFileExplorerCaching(port, self.reset)
             else:
                 self.fe = MpFileExplorer(port, self.reset)
+            if self.low_latency:
+                self.__set_low_latency()
+            if isinstance(self.fe.con, ConSerial):
+                self.fe.con.serial = BufferedSerial(self.fe.con.serial)
             print("Connected to %s" % self.fe.sysname)
         except PyboardError as e:
             logging.error(e)
@@ -122,8 +183,18 @@ class MpFileShell(cmd.Cmd):
             logging.error(e)
             self.__error("Failed to open: %s" % port)
 
+    def __set_low_latency(self):
+
+        # only serial connections have a latency timer to tune, telnet and websocket don't expose .serial
+        try:
+            self.fe.con.serial.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, OSError, ValueError) as e:
+            logging.debug("low latency mode not available: %s" % e)
+
     def __disconnect(self):
 
+        self._ls_cache.clear()
+
         if self.fe is not None:
             try:
                 self.fe.close()
@@ -142,7 +213,7 @@ class MpFileShell(cmd.Cmd):
 
     def __parse_file_names(self, args):
 
-        tokens, rest = self.tokenizer.tokenize(args)
+        tokens, rest = _tokenize(args)
 
         if rest != '':
             self.__error("Invalid filename given: %s" % rest)
@@ -151,6 +222,44 @@ class MpFileShell(cmd.Cmd):
 
         return None
 
+    def _cached_ls(self, add_files=True, add_dirs=True):
+        """
+        Remote listing for the completers. Readline calls them over and over
+        for the same prefix, so results are kept for LS_CACHE_TTL seconds.
+        """
+
+        key = (self.fe.pwd(), add_files, add_dirs)
+        now = time.monotonic()
+
+        hit = self._ls_cache.get(key)
+
+        if hit is not None and now - hit[0] < self.LS_CACHE_TTL:
+            return hit[1]
+
+        files = self.fe.ls(add_files=add_files, add_dirs=add_dirs)
+
+        self._ls_cache[key] = (now, files)
+
+        return files
+
+    def _complete(self, name, names, prefix):
+        """
+        Filter completion candidates by prefix. While the candidate list is
+        unchanged and the prefix only grows, the previous result of the
+        named completer is filtered instead of the full list.
+        """
+
+        candidates = names
+        hit = self._compl_cache.get(name)
+
+        if hit is not None and hit[0] is names and prefix.startswith(hit[1]):
+            candidates = hit[2]
+
+        result = [i for i in candidates if i.startswith(prefix)]
+        self._compl_cache[name] = (names, prefix, result)
+
+        return result
+
     def do_exit(self, args):
         """exit
         Exit this shell.
@@ -173,12 +282,9 @@ class MpFileShell(cmd.Cmd):
         if not len(args):
             self.__error("Missing argument: <TARGET>")
         else:
-            if not args.startswith("ser:/dev/") \
-                    and not args.startswith("ser:COM") \
-                    and not args.startswith("tn:") \
-                    and not args.startswith("ws:"):
+            if not args.startswith(("ser:/dev/", "ser:COM", "tn:", "ws:")):
 
-                if platform.system() == "Windows":
+                if _IS_WINDOWS:
                     args = "ser:" + args
                 else:
                     args = "ser:/dev/" + args
@@ -202,39 +308,36 @@ class MpFileShell(cmd.Cmd):
         """
 
         if self.__is_open():
-            olddir = self.fe.pwd()
+            olddir = None
             try:
                 if len(directory)!=0:
+                    olddir = self.fe.pwd()
                     self.fe.cd(directory)
-                    
+
+                current = self.fe.pwd()
                 files = self.fe.ls(add_details=True)
 
-                if self.fe.pwd() != "/":
+                if current != "/":
                     files = [("..", "D")] + files
 
-                print("\nRemote files in '%s':\n" % self.fe.pwd())
+                lines = ["\nRemote files in '%s':\n" % current]
 
                 # Sort alphabetically, then sort folders over files
-                files = sorted(sorted(files,key=lambda file: file[0]), key=lambda file: file[1])
+                files = sorted(files, key=lambda file: (file[1], file[0]))
 
                 for elem, type in files:
                     if type == 'F':
-                        if self.color:
-                            print(colorama.Fore.CYAN + ("       %s" % elem) + colorama.Fore.RESET)
-                        else:
-                            print("       %s" % elem)
+                        lines.append(self._file_fmt % elem)
                     else:
-                        if self.color:
-                            print(colorama.Fore.MAGENTA + (" <dir> %s" % elem) + colorama.Fore.RESET)
-                        else:
-                            print(" <dir> %s" % elem)
+                        lines.append(self._dir_fmt % elem)
 
-                print("")
+                lines.append("")
+                sys.stdout.write("\n".join(lines) + "\n")
 
             except IOError as e:
                 self.__error(str(e))
 
-            if len(directory)!=0:
+            if olddir is not None:
                 self.fe.cd(olddir)
 
     def do_tree(self, directory):
@@ -243,57 +346,50 @@ class MpFileShell(cmd.Cmd):
         """
 
         if self.__is_open():
-            olddir = self.fe.pwd()
-            if len(directory)!=0:
-                self.fe.cd(directory)
-            else:
-                directory = self.fe.pwd()
+            try:
+                target = directory if len(directory) != 0 else self.fe.pwd()
+                tree = self.fe.tree(target)
 
-            self.rec_tree(directory)
+                lines = []
+                self.rec_tree(lines, self.fe._abspath(target).rsplit("/", 1)[-1], tree)
+                sys.stdout.write("\n".join(lines) + "\n")
 
-            if len(directory)!=0:
-                self.fe.cd(olddir)
-    def rec_tree(self,directory,prefix=""):
-        try:
-            olddir = self.fe.pwd()
-            self.fe.cd(directory)
-            files = self.fe.ls(add_details=True)
-            if self.color:
-                print(colorama.Fore.MAGENTA + ("%s%s" % (prefix, self.fe.pwd().split("/")[-1])) + colorama.Fore.RESET)
+            except IOError as e:
+                self.__error(str(e))
+            except PyboardError as e:
+                self.__error(str(e))
+
+    def rec_tree(self, lines, name, tree, prefix=""):
+
+        lines.append(self._tree_dir_fmt % (prefix, name))
+
+        if len(prefix)>=4:
+            if prefix[-4]=='└':
+                prefix = prefix[:-4]+' '*4
+
+        files = [(elem, 'F' if sub is None else 'D') for elem, sub in tree.items()]
+        files = sorted(files, key=lambda file: (file[1], file[0]))
+
+        i = 0
+        for elem, type in files:
+            if type == 'F':
+                if len(prefix)>=3:
+                    fprefix = prefix[:-4]+(' ' if prefix[-4] == ' ' else '│' )+' '*3
+                else:
+                    fprefix = prefix
+                if len(files)==i+1:
+                    fprefix = fprefix+"└── "
+                else:
+                    fprefix = fprefix+"├── "
+
+                lines.append(self._tree_file_fmt % (fprefix, elem))
             else:
-                print("%s%s" % (prefix, self.fe.pwd().split("/")[-1]))
-
-            if len(prefix)>=4:
-                if prefix[-4]=='└':
-                    prefix = prefix[:-4]+' '*4
-            files = sorted(sorted(files,key=lambda file: file[0]), key=lambda file: file[1])
-
-            i = 0
-            for elem, type in files:
-                if type == 'F':
-                    if len(prefix)>=3:
-                        fprefix = prefix[:-4]+(' ' if prefix[-4] == ' ' else '│' )+' '*3
-                    else:
-                        fprefix = prefix
-                    if len(files)==i+1:
-                        fprefix = fprefix+"└── "
-                    else:
-                        fprefix = fprefix+"├── "
-                        
-                    if self.color:
-                        print(colorama.Fore.CYAN + ("%s%s" % (fprefix, elem)) + colorama.Fore.RESET)
-                    else:
-                        print("%s%s" % (fprefix, elem))
+                if len(files)==i+1:
+                    self.rec_tree(lines, elem, tree[elem], prefix+"└── ")
                 else:
-                    if len(files)==i+1:
-                        self.rec_tree(self.fe._fqn(elem),prefix+"└── ")
-                    else:
-                        self.rec_tree(self.fe._fqn(elem),prefix+"├── ")
-                i+=1
-            self.fe.cd(olddir)
+                    self.rec_tree(lines, elem, tree[elem], prefix+"├── ")
+            i+=1
 
-        except IOError as e:
-            self.__error(str(e))
     def do_pwd(self, args):
         """pwd
          Print current remote directory.
@@ -316,6 +412,7 @@ class MpFileShell(cmd.Cmd):
                     self.__error("Only one argument allowed: <REMOTE DIR>")
                     return
 
+                self._ls_cache.clear()
                 self.fe.cd(s_args[0])
                 self.__set_prompt_path()
             except IOError as e:
@@ -326,11 +423,11 @@ class MpFileShell(cmd.Cmd):
     def complete_cd(self, *args):
 
         try:
-            files = self.fe.ls(add_files=False)
+            files = self._cached_ls(add_files=False)
         except Exception:
             files = []
 
-        return [i for i in files if i.startswith(args[0])]
+        return self._complete("cd", files, args[0])
 
     def do_md(self, args):
         """md <TARGET DIR>
@@ -347,6 +444,7 @@ class MpFileShell(cmd.Cmd):
                     self.__error("Only one argument allowed: <REMOTE DIR>")
                     return
 
+                self._ls_cache.clear()
                 self.fe.md(s_args[0])
             except IOError as e:
                 self.__error(str(e))
@@ -356,23 +454,20 @@ class MpFileShell(cmd.Cmd):
         List files in current local directory.
         """
 
-        files = os.listdir(".")
+        with os.scandir(".") as it:
+            entries = list(it)
 
-        print("\nLocal files:\n")
+        lines = ["\nLocal files:\n"]
 
-        for f in files:
-            if os.path.isdir(f):
-                if self.color:
-                    print(colorama.Fore.MAGENTA + (" <dir> %s" % f) + colorama.Fore.RESET)
-                else:
-                    print(" <dir> %s" % f)
-        for f in files:
-            if os.path.isfile(f):
-                if self.color:
-                    print(colorama.Fore.CYAN + ("       %s" % f) + colorama.Fore.RESET)
-                else:
-                    print("       %s" % f)
-        print("")
+        for e in entries:
+            if e.is_dir():
+                lines.append(self._dir_fmt % e.name)
+        for e in entries:
+            if e.is_file():
+                lines.append(self._file_fmt % e.name)
+
+        lines.append("")
+        sys.stdout.write("\n".join(lines) + "\n")
 
     def do_lcd(self, args):
         """lcd <TARGET DIR>
@@ -392,10 +487,11 @@ class MpFileShell(cmd.Cmd):
 
                 os.chdir(s_args[0])
             except OSError as e:
-                self.__error(str(e).split("] ")[-1])
+                self.__error(str(e).rpartition("] ")[2])
 
     def complete_lcd(self, *args):
-        dirs = [o for o in os.listdir(".") if os.path.isdir(os.path.join(".", o))]
+        with os.scandir(".") as it:
+            dirs = [e.name for e in it if e.is_dir()]
         return [i for i in dirs if i.startswith(args[0])]
 
     def do_lpwd(self, args):
@@ -424,6 +520,8 @@ class MpFileShell(cmd.Cmd):
                 self.__error("Only one ore two arguments allowed: <LOCAL FILE> [<REMOTE FILE>]")
                 return
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.put(src=s_args[0], dst=(s_args[1] if len(s_args)>1 else None))
             except IOError as e:
@@ -448,13 +546,16 @@ class MpFileShell(cmd.Cmd):
                 self.__error("Only one ore two arguments allowed: <LOCAL DIRECTORY> [<REMOTE DIRECTORY>]")
                 return
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.putr(src=s_args[0], dst=(s_args[1] if len(s_args)>1 else None))
             except IOError as e:
                 self.__error(str(e))
 
     def complete_put(self, *args):
-        files = [o for o in os.listdir(".") if os.path.isfile(os.path.join(".", o))]
+        with os.scandir(".") as it:
+            files = [e.name for e in it if e.is_file()]
         return [i for i in files if i.startswith(args[0])]
 
     def do_mput(self, args):
@@ -470,6 +571,8 @@ class MpFileShell(cmd.Cmd):
 
         elif self.__is_open():
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.mput(os.getcwd(), args, True)
             except IOError as e:
@@ -521,6 +624,8 @@ class MpFileShell(cmd.Cmd):
                 self.fe.getr(src=s_args[0], dst=(s_args[1] if len(s_args)>1 else None))
             except IOError as e:
                 self.__error(str(e))
+            except PyboardError as e:
+                self.__error(str(e))
 
     def do_mget(self, args):
         """mget <SELECTION REGEX>
@@ -539,15 +644,17 @@ class MpFileShell(cmd.Cmd):
                 self.fe.mget(os.getcwd(), args, True)
             except IOError as e:
                 self.__error(str(e))
+            except PyboardError as e:
+                self.__error(str(e))
 
     def complete_get(self, *args):
 
         try:
-            files = self.fe.ls(add_dirs=False)
+            files = self._cached_ls(add_dirs=False)
         except Exception:
             files = []
 
-        return [i for i in files if i.startswith(args[0])]
+        return self._complete("get", files, args[0])
 
     def do_rm(self, args):
         """rm <REMOTE FILE>
@@ -567,6 +674,8 @@ class MpFileShell(cmd.Cmd):
                 self.__error("Only one argument allowed: <REMOTE FILE>")
                 return
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.rm(s_args[0])
             except IOError as e:
@@ -592,6 +701,8 @@ class MpFileShell(cmd.Cmd):
                 self.__error("Only one argument allowed: <REMOTE DIRECTORY>")
                 return
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.rmr(s_args[0])
             except IOError as e:
@@ -611,19 +722,23 @@ class MpFileShell(cmd.Cmd):
 
         elif self.__is_open():
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.mrm(args, True)
             except IOError as e:
                 self.__error(str(e))
+            except PyboardError as e:
+                self.__error(str(e))
 
     def complete_rm(self, *args):
 
         try:
-            files = self.fe.ls()
+            files = self._cached_ls()
         except Exception:
             files = []
 
-        return [i for i in files if i.startswith(args[0])]
+        return self._complete("rm", files, args[0])
 
     def do_cat(self, args):
         """cat <REMOTE FILE>
@@ -653,18 +768,28 @@ class MpFileShell(cmd.Cmd):
         Execute a Python statement on remote.
         """
 
+        # multi-byte characters may be split across chunks
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+
         def data_consumer(data):
-            data = str(data.decode('utf-8'))
-            sys.stdout.write(data.strip("\x04"))
+            data = decoder.decode(data.replace(b"\x04", b""))
+            sys.stdout.write(data)
+            if "\n" in data:
+                sys.stdout.flush()
 
         if not len(args):
             self.__error("Missing argument: <STATEMENT>")
         elif self.__is_open():
 
+            self._ls_cache.clear()
+
             try:
                 self.fe.exec_raw_no_follow(args + "\n")
                 ret = self.fe.follow(None, data_consumer)
 
+                sys.stdout.write(decoder.decode(b"", final=True))
+                sys.stdout.flush()
+
                 if len(ret[-1]):
                     self.__error(ret[-1])
 
@@ -678,22 +803,23 @@ class MpFileShell(cmd.Cmd):
         Enter Micropython REPL.
         """
 
-        import serial
-
-        ver = serial.VERSION.split(".")
-
-        if int(ver[0]) < 2 or (int(ver[0]) == 2 and int(ver[1]) < 7):
+        if _PYSERIAL_VER is not None and _PYSERIAL_VER < (2, 7):
             self.__error("REPL needs PySerial version >= 2.7, found %s" % serial.VERSION)
             return
 
+        if Term is None:
+            self.__error("REPL not available, failed to import terminal support: %s" % _TERM_IMPORT_ERROR)
+            return
+
         if self.__is_open():
 
+            self._ls_cache.clear()
+
             if self.repl is None:
 
-                from mp.term import Term
                 self.repl = Term(self.fe.con)
 
-                if platform.system() == "Windows":
+                if _IS_WINDOWS:
                     self.repl.exit_character = chr(0x11)
                 else:
                     self.repl.exit_character = chr(0x1d)
@@ -756,10 +882,31 @@ class MpFileShell(cmd.Cmd):
     #            self.__error(str(e))     
 
     def complete_mpyc(self, *args):
-        files = [o for o in os.listdir(".") if (os.path.isfile(os.path.join(".", o)) and o.endswith(".py"))]
+        with os.scandir(".") as it:
+            files = [e.name for e in it if e.name.endswith(".py") and e.is_file()]
         return [i for i in files if i.startswith(args[0])]
 
 
+def batch_exec(commands):
+    """
+    Merge runs of consecutive exec commands into a single exec, so their
+    statements are sent to the remote in one exchange.
+
+    :param commands:    List of shell commands
+    :return:            List of shell commands with exec runs merged
+    """
+
+    batched = []
+
+    for command in commands:
+        if command.startswith("exec ") and len(batched) and batched[-1].startswith("exec "):
+            batched[-1] += "\n" + command[5:].strip()
+        else:
+            batched.append(command)
+
+    return batched
+
+
 def main():
 
     parser = argparse.ArgumentParser()
@@ -770,6 +917,8 @@ def main():
 
     parser.add_argument("--nocolor", help="disable color", action="store_true", default=False)
     parser.add_argument("--nocache", help="disable cache", action="store_true", default=False)
+    parser.add_argument("--nolowlatency", help="do not switch serial port into low latency mode",
+                        action="store_true", default=False)
 
     parser.add_argument("--logfile", help="write log to file", default=None)
     parser.add_argument("--loglevel", help="loglevel (CRITICAL, ERROR, WARNING, INFO, DEBUG)", default="INFO")
@@ -790,34 +939,29 @@ def main():
     logging.info('Running on Python %d.%d using PySerial %s' \
               % (sys.version_info[0], sys.version_info[1], serial.VERSION))
 
-    mpfs = MpFileShell(not args.nocolor, not args.nocache, args.reset)
+    mpfs = MpFileShell(not args.nocolor, not args.nocache, args.reset, not args.nolowlatency,
+                       args.noninteractive or args.script is not None)
 
     if args.command is not None:
 
-        for cmd in ' '.join(args.command).split(';'):
-            scmd = cmd.strip()
-            if len(scmd) > 0 and not scmd.startswith('#'):
-                mpfs.onecmd(scmd)
-
-    elif args.script is not None:
+        commands = [cmd.strip() for cmd in ' '.join(args.command).split(';')]
 
-        f = open(args.script, 'r')
-        script = ""
+        for scmd in batch_exec([cmd for cmd in commands if len(cmd) > 0 and not cmd.startswith('#')]):
+            mpfs.onecmd(scmd)
 
-        for line in f:
+    elif args.script is not None:
 
-            sline = line.strip()
+        with open(args.script, 'r') as f:
+            lines = [line.strip() for line in f.read().splitlines()]
 
-            if len(sline) > 0 and not sline.startswith('#'):
-                script += sline + '\n'
+        lines = [line for line in lines if len(line) > 0 and not line.startswith('#')]
 
-        if sys.version_info < (3, 0):
-            sys.stdin = io.StringIO(script.decode('utf-8'))
-        else:
-            sys.stdin = io.StringIO(script)
+        # a script always ends the session, just like reaching EOF in the shell
+        for line in batch_exec(lines):
+            if mpfs.onecmd(line):
+                break
 
-        mpfs.intro = ''
-        mpfs.prompt = ''
+        return
 
     if not args.noninteractive:
 
@@ -57,16 +57,17 @@ class Pyboard:
 
     def read_until(self, min_num_bytes, ending, timeout=10, data_consumer=None):
 
-        data = self.con.read(min_num_bytes)
+        # a bytearray keeps appending linear for large transfers
+        data = bytearray(self.con.read(min_num_bytes))
         if data_consumer:
-            data_consumer(data)
+            data_consumer(bytes(data))
         timeout_count = 0
         while True:
             if data.endswith(ending):
                 break
             elif self.con.inWaiting() > 0:
                 new_data = self.con.read(1)
-                data = data + new_data
+                data.extend(new_data)
                 if data_consumer:
                     data_consumer(new_data)
                 timeout_count = 0
@@ -75,7 +76,7 @@ class Pyboard:
                 if timeout is not None and timeout_count >= 100 * timeout:
                     break
                 time.sleep(0.01)
-        return data
+        return bytes(data)
 
     def enter_raw_repl(self):
 
@@ -190,10 +191,10 @@ class Pyboard:
         self.throw_exception_on_error(ret,ret_err)
         return ret
 
-    def exec_with_exception(self, expression):
+    def exec_with_exception(self, expression, data_consumer=None):
         expression = expression.replace("\n","\n  ")
         # Wrap the execution in an exception handler which gathers data. Then write it to stderr after a x04 to force it to be registered as an error. The special x1F is used to signify that this is one of the internal errors and not an exception in the exception handler.
-        ret, ret_err = self.exec_raw(InternalError.errorHandlerFormat.format(expression))
+        ret, ret_err = self.exec_raw(InternalError.errorHandlerFormat.format(expression), data_consumer=data_consumer)
         self.throw_exception_on_error(ret,ret_err)
         return ret
 
@@ -0,0 +1,15 @@
+import pytest
+
+from mp.mpfshell import batch_exec
+
+
+class TestBatchExec:
+
+    def test_consecutive_exec_merged(self):
+
+        assert batch_exec(["open ttyUSB0", "exec a = 1", "exec  print(a)", "ls", "exec b = 2"]) == \
+            ["open ttyUSB0", "exec a = 1\nprint(a)", "ls", "exec b = 2"]
+
+    def test_other_commands_untouched(self):
+
+        assert batch_exec(["exec", "exec a = 1", "lls", "lpwd"]) == ["exec", "exec a = 1", "lls", "lpwd"]
@@ -0,0 +1,55 @@
+import pytest
+
+from mp.buffered_serial import BufferedSerial
+
+
+class FakeSerial(object):
+
+    def __init__(self, data):
+
+        self.data = data
+        self.reads = 0
+        self.port = "/dev/ttyFAKE"
+
+    def read(self, size=1):
+
+        self.reads += 1
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+    def inWaiting(self):
+
+        return len(self.data)
+
+
+class TestBufferedSerial:
+
+    def test_small_reads_served_from_buffer(self):
+
+        ser = FakeSerial(b"raw REPL; CTRL-B to exit\r\n>")
+        bs = BufferedSerial(ser)
+
+        data = b""
+        while bs.inWaiting() > 0:
+            data += bs.read(1)
+
+        assert data == b"raw REPL; CTRL-B to exit\r\n>"
+        assert ser.reads == 1
+
+    def test_read_more_than_buffered(self):
+
+        ser = FakeSerial(b"OK1234")
+        bs = BufferedSerial(ser)
+
+        assert bs.read(1) == b"O"
+        assert bs.inWaiting() == 5
+        assert bs.read(3) == b"K12"
+        assert bs.read(4) == b"34"
+        assert bs.inWaiting() == 0
+
+    def test_attribute_passthrough(self):
+
+        bs = BufferedSerial(FakeSerial(b""))
+
+        assert bs.port == "/dev/ttyFAKE"
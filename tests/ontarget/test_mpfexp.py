@@ -247,6 +247,103 @@ class TestMpfexp:
         with pytest.raises(RemoteIOError):
             mpfexp.mget(".", "*")
 
+    def test_tree(self, mpfexp, tmpdir):
+
+        os.chdir(str(tmpdir))
+        self.__create_local_file("file50", b"\x01\x02")
+
+        mpfexp.md("dir8")
+        mpfexp.md("dir8/sub 1")
+        mpfexp.md("dir8/sub 1/empty")
+        mpfexp.put("file50", "dir8/file1")
+        mpfexp.put("file50", "dir8/sub 1/file 2")
+
+        assert {"file1": None, "sub 1": {"empty": {}, "file 2": None}} == mpfexp.tree("dir8")
+
+        # relative to the current directory
+        mpfexp.cd("dir8")
+        assert {"empty": {}, "file 2": None} == mpfexp.tree("sub 1")
+        mpfexp.cd("/")
+
+        assert mpfexp.tree("/")["dir8"] == mpfexp.tree("/dir8")
+
+        with pytest.raises(RemoteIOError):
+            mpfexp.tree("dir99")
+
+    def test_mrm(self, mpfexp, tmpdir):
+
+        os.chdir(str(tmpdir))
+        self.__create_local_file("file60")
+
+        mpfexp.md("dir9")
+        mpfexp.cd("dir9")
+
+        for name in ["file60", "file61", "file 62", "other"]:
+            mpfexp.put("file60", name)
+
+        mpfexp.md("file63")
+
+        # only matching files are removed, never directories
+        mpfexp.mrm("file.*")
+        assert [("file63", "D"), ("other", "F")] == sorted(mpfexp.ls(True, True, True))
+
+        mpfexp.mrm("notmatching")
+        assert [("file63", "D"), ("other", "F")] == sorted(mpfexp.ls(True, True, True))
+
+        with pytest.raises(RemoteIOError):
+            mpfexp.mrm("*")
+
+        mpfexp.cd("/")
+
+    def test_getr(self, mpfexp, tmpdir):
+
+        os.chdir(str(tmpdir))
+
+        # binary data over several chunks, ending on a chunk boundary
+        data = bytes(range(256)) * 4 + b"\x00" * 64
+        self.__create_local_file("file70", data)
+        self.__create_local_file("file71")
+
+        mpfexp.md("dir10")
+        mpfexp.md("dir10/sub 1")
+        mpfexp.md("dir10/sub 1/empty")
+        mpfexp.put("file70", "dir10/file1")
+        mpfexp.put("file71", "dir10/sub 1/file 2")
+
+        mpfexp.getr("dir10", "copy")
+
+        with open(os.path.join("copy", "file1"), "rb") as f:
+            assert data == f.read()
+
+        with open(os.path.join("copy", "sub 1", "file 2"), "rb") as f:
+            assert b"" == f.read()
+
+        assert os.path.isdir(os.path.join("copy", "sub 1", "empty"))
+
+        # several files with content in one mget
+        mpfexp.put("file70", "dir10/file2")
+        mpfexp.cd("dir10")
+        os.mkdir("mget")
+        mpfexp.mget("mget", "file.*")
+        mpfexp.cd("/")
+
+        assert ["file1", "file2"] == sorted(os.listdir("mget"))
+
+        for name in ["file1", "file2"]:
+            with open(os.path.join("mget", name), "rb") as f:
+                assert data == f.read()
+
+        # local target is not a directory
+        with pytest.raises(RemoteIOError):
+            mpfexp.getr("dir10", "file70")
+
+        # remote source is not a directory or does not exist
+        with pytest.raises(RemoteIOError):
+            mpfexp.getr("dir10/file1")
+
+        with pytest.raises(RemoteIOError):
+            mpfexp.getr("dir99")
+
     def test_putsgets(self, mpfexp):
 
         mpfexp.md("dir5")